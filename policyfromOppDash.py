@@ -1,15 +1,26 @@
 import streamlit as st
-from simple_salesforce import Salesforce
-import os
+from simple_salesforce import format_soql
+from simple_salesforce.exceptions import SalesforceExpiredSession
+from sf_client import get_sf
 from dotenv import load_dotenv
 import plotly.express as px
 import pandas as pd
+import numpy as np
 import pytz
 from datetime import datetime, timedelta
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Upper bound on premium histogram bins, similar to plotly.js auto-binning
+MAX_HISTOGRAM_BINS = 100
+
+# DateTime literal format expected by SOQL, also produced by get_date_range
+SOQL_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+# Reporting timezone, looked up once instead of on every rerun
+_EASTERN = pytz.timezone("US/Eastern")
+
 # Set page configuration
 st.set_page_config(
     page_title="New Business Binds",
@@ -18,10 +29,10 @@ st.set_page_config(
 )
 
 # Function to calculate date ranges using US/Eastern timezone
+@st.cache_data(ttl=60, show_spinner=False)
 def get_date_range(period):
     """Return start and end ISO dates for the selected period (Week, Month, Quarter, Custom)."""
-    tz = pytz.timezone("US/Eastern")
-    today = datetime.now(tz)
+    today = datetime.now(_EASTERN)
     
     if period == "Week":
         # Monday start and Sunday end
@@ -32,11 +43,11 @@ def get_date_range(period):
         end_of_period = (start_of_period + timedelta(days=31)).replace(day=1) - timedelta(seconds=1)
     elif period == "Quarter":
         quarter = (today.month - 1) // 3 + 1
-        start_of_period = datetime(today.year, 3 * quarter - 2, 1, tzinfo=tz)
+        start_of_period = datetime(today.year, 3 * quarter - 2, 1, tzinfo=_EASTERN)
         if quarter < 4:
-            end_of_period = datetime(today.year, 3 * quarter + 1, 1, tzinfo=tz) - timedelta(seconds=1)
+            end_of_period = datetime(today.year, 3 * quarter + 1, 1, tzinfo=_EASTERN) - timedelta(seconds=1)
         else:
-            end_of_period = datetime(today.year, 12, 31, 23, 59, 59, tzinfo=tz)
+            end_of_period = datetime(today.year, 12, 31, 23, 59, 59, tzinfo=_EASTERN)
     elif period == "Custom":
         # For Custom, we'll return None values and handle the date picker separately
         return None, None
@@ -44,55 +55,74 @@ def get_date_range(period):
         raise ValueError("Invalid period selected")
     
     # Convert to the correct DateTime string format for Salesforce
-    return start_of_period.strftime("%Y-%m-%dT%H:%M:%S%z"), end_of_period.strftime("%Y-%m-%dT%H:%M:%S%z")
+    return start_of_period.strftime(SOQL_DATETIME_FORMAT), end_of_period.strftime(SOQL_DATETIME_FORMAT)
+
+
+# Build a SOQL query with validated DateTime bounds instead of raw f-string interpolation
+def build_soql(template, start_date, end_date):
+    """Validate the ISO date bounds and substitute them into the SOQL template."""
+    for value in (start_date, end_date):
+        # Raises ValueError for anything that isn't a SOQL DateTime literal
+        datetime.strptime(value, SOQL_DATETIME_FORMAT)
+    return format_soql(template, start_date=start_date, end_date=end_date)
+
+
+# Cached SOQL query so identical date ranges are served from memory
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_policies(start_date, end_date):
+    """Run the policies SOQL query for the date range and return (df, soql_query)."""
+    sf = get_sf()
+
+    # Updated SOQL query based on the new requirements
+    soql_query = build_soql("""
+        SELECT PolicyType, COUNT(Id) PolicyCount, SUM(Total_Policy_Premium__c) TotalPremium, MIN(EffectiveDate) EffectiveDate
+        FROM InsurancePolicy
+        WHERE SourceOpportunityId != NULL
+        AND Business_Type_Reporting__c = 'New Business'
+        AND EffectiveDate >= {start_date:literal}
+        AND EffectiveDate <= {end_date:literal}
+        AND Status = 'Active'
+        GROUP BY SourceOpportunityId, PolicyType
+        LIMIT 2000
+    """, start_date, end_date)
+
+    # Aggregate queries return a single page (no queryMore), so iterate it once and keep
+    # only the needed fields rather than the full records and their 'attributes' sub-dicts
+    policy_types, policy_counts, total_premiums, effective_dates = [], [], [], []
+    for r in sf.query_all_iter(soql_query):
+        policy_types.append(r['PolicyType'])
+        policy_counts.append(r['PolicyCount'])
+        total_premiums.append(r.get('TotalPremium') or 0.0)
+        effective_dates.append(r['EffectiveDate'])
+
+    # Build typed columns straight from the extracted fields
+    df = pd.DataFrame({
+        'PolicyType': policy_types,
+        'PolicyCount': np.array(policy_counts, dtype=np.int32),
+        'TotalPremium': np.array(total_premiums, dtype=np.float64),
+        'EffectiveDate': pd.to_datetime(effective_dates, format='ISO8601', utc=True, cache=True),
+    }, copy=False)
+
+    # Optional: log dataframe columns for debugging (hidden now)
+    # st.write("Returned columns:", df.columns.tolist())
+    
+    df['OpportunityIndex'] = np.arange(1, len(df) + 1, dtype=np.int32)
+    # Low-cardinality column: categorical codes make groupby and isin integer operations
+    df['PolicyType'] = df['PolicyType'].astype('category')
+
+    return df, soql_query
 
 
 # Function to connect to Salesforce and execute SOQL query for policies
 def connect_to_salesforce_and_run_query(start_date, end_date):
     try:
-        # Connect to Salesforce
-        sf = Salesforce(
-            username=os.getenv("SF_USERNAME_PRO"),
-            password=os.getenv("SF_PASSWORD_PRO"),
-            security_token=os.getenv("SF_SECURITY_TOKEN_PRO"),
-        )
+        try:
+            df, soql_query = fetch_policies(start_date, end_date)
+        except SalesforceExpiredSession:
+            # The cached client's session timed out: log in again and retry once
+            get_sf.clear()
+            df, soql_query = fetch_policies(start_date, end_date)
         st.success("Salesforce connection successful!")
-
-        # Updated SOQL query based on the new requirements
-        soql_query = f"""
-            SELECT PolicyType, COUNT(Id) PolicyCount, SUM(Total_Policy_Premium__c) TotalPremium, MIN(EffectiveDate) EffectiveDate
-            FROM InsurancePolicy
-            WHERE SourceOpportunityId != NULL
-            AND Business_Type_Reporting__c = 'New Business'
-            AND EffectiveDate >= {start_date}
-            AND EffectiveDate <= {end_date}
-            AND Status = 'Active'
-            GROUP BY SourceOpportunityId, PolicyType
-            LIMIT 2000
-        """
-        
-        query_results = sf.query_all(soql_query)
-        records = query_results['records']
-        
-        # Use queryMore to retrieve all pages if there are more records
-        while 'nextRecordsUrl' in query_results:
-            query_results = sf.query_more(query_results['nextRecordsUrl'], True)
-            records.extend(query_results['records'])
-        
-        # Create DataFrame from records
-        df = pd.DataFrame(records)
-        
-        # Drop 'Attributes' column if it exists
-        df = df.drop(columns=['attributes'], errors='ignore')
-
-        # Optional: log dataframe columns for debugging (hidden now)
-        # st.write("Returned columns:", df.columns.tolist())
-        
-        df['OpportunityIndex'] = range(1, len(df) + 1)
-        df['PolicyCount'] = df['PolicyCount'].astype(int)
-        df['TotalPremium'] = pd.to_numeric(df['TotalPremium'], errors='coerce').fillna(0)
-        df['EffectiveDate'] = pd.to_datetime(df['EffectiveDate'])
-
         return df, soql_query
 
     except Exception as e:
@@ -100,6 +130,84 @@ def connect_to_salesforce_and_run_query(start_date, end_date):
         return None, None
 
 
+# PolicyType aggregation used by the charts, cached through build_chart
+def compute_policy_type_analysis(filtered_df):
+    """Return total policy count and premium per PolicyType for the filtered policies."""
+    return filtered_df.groupby('PolicyType', observed=True).agg({
+        'PolicyCount': 'sum',
+        'TotalPremium': 'sum'
+    }).reset_index()
+
+
+# Cached chart figures, so switching back to a chart type doesn't rebuild its figure;
+# bounded like fetch_policies so figures don't outlive the data they were built from
+@st.cache_data(ttl=300, max_entries=50, show_spinner=False)
+def build_chart(chart_type, filtered_df):
+    """Return the Plotly figure for the selected chart type and filtered policies."""
+    # Group by PolicyType for analysis
+    policy_type_analysis = compute_policy_type_analysis(filtered_df)
+    
+    if chart_type == "Premium by Policy Type":
+        fig = px.bar(policy_type_analysis, x='PolicyType', y='TotalPremium',
+                     title="Total Premium by Line of Business",
+                     labels={"PolicyType": "Line of Business", "TotalPremium": "Total Premium ($)"},
+                     color='PolicyType')
+    elif chart_type == "Bar Chart":
+        fig = px.bar(policy_type_analysis, x='PolicyType', y='PolicyCount',
+                     title="Policies by Line of Business",
+                     labels={"PolicyType": "Line of Business", "PolicyCount": "Policy Count"},
+                     color='PolicyType')
+    elif chart_type == "Scatter Plot":
+        fig = px.scatter(policy_type_analysis, x='PolicyCount', y='TotalPremium',
+                         title="Premium vs Policy Count by Line of Business",
+                         labels={"PolicyCount": "Policy Count", "TotalPremium": "Total Premium ($)"},
+                         color='PolicyType', size='PolicyCount')
+    elif chart_type == "Line Chart":
+        # Sort by premium amount for better visualization
+        sorted_data = policy_type_analysis.sort_values('TotalPremium', ascending=False)
+        fig = px.line(sorted_data, x='PolicyType', y=['PolicyCount', 'TotalPremium'],
+                      title="Policies and Premium by Line of Business",
+                      labels={"PolicyType": "Line of Business", "value": "Count/Amount", "variable": "Metric"})
+    elif chart_type == "Histogram":
+        # Pre-bin premiums so only per-bin counts are sent to the browser; numpy's 'auto'
+        # rule is unbounded on skewed premiums, so cap the bin count
+        bin_edges = np.histogram_bin_edges(filtered_df['TotalPremium'], bins='auto')
+        if len(bin_edges) - 1 > MAX_HISTOGRAM_BINS:
+            bin_edges = np.histogram_bin_edges(filtered_df['TotalPremium'], bins=MAX_HISTOGRAM_BINS)
+        bin_index = np.clip(np.searchsorted(bin_edges, filtered_df['TotalPremium'], side='right') - 1, 0, len(bin_edges) - 2)
+        histogram_data = filtered_df.groupby(
+            ['PolicyType', pd.Series(bin_index, index=filtered_df.index, name='Bin')], observed=True
+        ).size().reset_index(name='count')
+        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+        histogram_data['TotalPremium'] = bin_centers[histogram_data['Bin']]
+
+        fig = px.bar(histogram_data, x='TotalPremium', y='count',
+                     title="Distribution of Policies by Premium",
+                     color='PolicyType')
+        fig.update_traces(width=bin_edges[1] - bin_edges[0])
+        fig.update_layout(bargap=0)
+    elif chart_type == "Box Plot":
+        fig = px.box(filtered_df, x='PolicyType', y='TotalPremium',
+                     title="Premium by Line of Business (Box Plot)",
+                     color='PolicyType')
+    else:
+        raise ValueError("Invalid chart type selected")
+
+    return fig
+
+
+# Chart section as a fragment so switching chart type reruns only this part of the page
+@st.fragment
+def render_visualizations(filtered_df):
+    """Render the chart type selector and the selected chart for the filtered policies."""
+    chart_type = st.selectbox(
+        "Select Chart Type",
+        options=["Premium by Policy Type", "Bar Chart", "Scatter Plot", "Line Chart", "Histogram", "Box Plot"]
+    )
+
+    st.plotly_chart(build_chart(chart_type, filtered_df))
+
+
 # Streamlit UI - Dashboard Layout
 st.title("New Business Binds Dashboard")
 
@@ -107,9 +215,11 @@ if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
     st.session_state.df = None
     st.session_state.query = None
-    st.session_state.force_query = False
+    st.session_state.last_filter_key = None
     st.session_state.custom_start_date = None
     st.session_state.custom_end_date = None
+    st.session_state.pt_index = None
+    st.session_state.unique_policy_types = []
 
 st.sidebar.header("Authentication & Filter Options")
 
@@ -119,8 +229,7 @@ selected_period = st.sidebar.selectbox("Select Period", options=["Week", "Month"
 # Handle custom date range if selected
 if selected_period == "Custom":
     # Get current eastern time for default values
-    eastern_tz = pytz.timezone("US/Eastern")
-    today = datetime.now(eastern_tz)
+    today = datetime.now(_EASTERN)
     
     # Default to last 30 days if not previously set
     if not st.session_state.custom_start_date:
@@ -143,12 +252,12 @@ if selected_period == "Custom":
     st.session_state.custom_end_date = custom_end_date
     
     # Convert date objects to Eastern timezone datetime with proper time boundaries
-    start_datetime = datetime.combine(custom_start_date, datetime.min.time()).replace(tzinfo=eastern_tz)
-    end_datetime = datetime.combine(custom_end_date, datetime.max.time()).replace(tzinfo=eastern_tz)
+    start_datetime = datetime.combine(custom_start_date, datetime.min.time()).replace(tzinfo=_EASTERN)
+    end_datetime = datetime.combine(custom_end_date, datetime.max.time()).replace(tzinfo=_EASTERN)
     
     # Format for Salesforce query
-    start_date = start_datetime.strftime("%Y-%m-%dT%H:%M:%S%z")
-    end_date = end_datetime.strftime("%Y-%m-%dT%H:%M:%S%z")
+    start_date = start_datetime.strftime(SOQL_DATETIME_FORMAT)
+    end_date = end_datetime.strftime(SOQL_DATETIME_FORMAT)
 else:
     # Use the existing function for predefined periods
     start_date, end_date = get_date_range(selected_period)
@@ -159,31 +268,31 @@ st.sidebar.write(f"**Date Range:**\nFrom: {start_date}\nTo: {end_date}")
 # Button to trigger query
 run_query_button = st.sidebar.button("Authenticate & Run Query")
 
-if run_query_button:
-    # If the button is pressed, authenticate and fetch the data
-    st.session_state.force_query = True
-
-# Authenticate and fetch data only when button is pressed or period is changed
-if st.session_state.force_query or not st.session_state.authenticated:
-    if run_query_button:
-        # Authenticate and fetch the query when the button is pressed
-        df, query = connect_to_salesforce_and_run_query(start_date, end_date)
-        if df is not None:
-            st.session_state.authenticated = True
-            st.session_state.df = df
-            st.session_state.query = query
-            st.session_state.force_query = False
-            st.sidebar.success("Authentication successful. You can now view and filter the data.")
-else:
+# Query only when the button is pressed for a date range that hasn't been loaded yet
+filter_key = (start_date, end_date)
+if run_query_button and filter_key != st.session_state.last_filter_key:
+    df, query = connect_to_salesforce_and_run_query(start_date, end_date)
+    if df is not None:
+        st.session_state.authenticated = True
+        st.session_state.df = df
+        st.session_state.query = query
+        st.session_state.last_filter_key = filter_key
+        # Row positions per PolicyType so filtering is integer indexing rather than a mask
+        st.session_state.pt_index = df.groupby('PolicyType', observed=True).indices
+        # Categories of the categorical column are already the sorted unique policy types
+        st.session_state.unique_policy_types = df['PolicyType'].cat.categories.tolist()
+        st.sidebar.success("Authentication successful. You can now view and filter the data.")
+elif st.session_state.authenticated:
     st.sidebar.success("Already authenticated. You can view and interact with the data.")
 
 if st.session_state.authenticated:
     # Use the "PolicyType" field for filtering
-    unique_policy_types = sorted(st.session_state.df['PolicyType'].dropna().unique())
+    unique_policy_types = st.session_state.unique_policy_types
     selected_policy_types = st.sidebar.multiselect("Select Policy Types", options=unique_policy_types, default=unique_policy_types)
 
     # Filter the dataframe based on PolicyType selection
-    filtered_df = st.session_state.df[st.session_state.df['PolicyType'].isin(selected_policy_types)]
+    positions = [st.session_state.pt_index[pt] for pt in selected_policy_types]
+    filtered_df = st.session_state.df.iloc[np.sort(np.concatenate(positions)) if positions else []]
 
     # Display current month and year at the top
     current_month_year = datetime.now().strftime("%B %Y")
@@ -204,51 +313,6 @@ if st.session_state.authenticated:
     st.dataframe(filtered_df)
 
     st.subheader("Visualizations")
-    chart_type = st.sidebar.selectbox(
-        "Select Chart Type",
-        options=["Premium by Policy Type", "Bar Chart", "Scatter Plot", "Line Chart", "Histogram", "Box Plot"]
-    )
-
-    # Group by PolicyType for analysis
-    policy_type_analysis = filtered_df.groupby('PolicyType').agg({
-        'PolicyCount': 'sum',
-        'TotalPremium': 'sum'
-    }).reset_index()
-    
-    if chart_type == "Premium by Policy Type":
-        fig = px.bar(policy_type_analysis, x='PolicyType', y='TotalPremium',
-                     title="Total Premium by Line of Business",
-                     labels={"PolicyType": "Line of Business", "TotalPremium": "Total Premium ($)"},
-                     color='PolicyType')
-        st.plotly_chart(fig)
-    elif chart_type == "Bar Chart":
-        fig = px.bar(policy_type_analysis, x='PolicyType', y='PolicyCount',
-                     title="Policies by Line of Business",
-                     labels={"PolicyType": "Line of Business", "PolicyCount": "Policy Count"},
-                     color='PolicyType')
-        st.plotly_chart(fig)
-    elif chart_type == "Scatter Plot":
-        fig = px.scatter(policy_type_analysis, x='PolicyCount', y='TotalPremium',
-                         title="Premium vs Policy Count by Line of Business",
-                         labels={"PolicyCount": "Policy Count", "TotalPremium": "Total Premium ($)"},
-                         color='PolicyType', size='PolicyCount')
-        st.plotly_chart(fig)
-    elif chart_type == "Line Chart":
-        # Sort by premium amount for better visualization
-        sorted_data = policy_type_analysis.sort_values('TotalPremium', ascending=False)
-        fig = px.line(sorted_data, x='PolicyType', y=['PolicyCount', 'TotalPremium'],
-                      title="Policies and Premium by Line of Business",
-                      labels={"PolicyType": "Line of Business", "value": "Count/Amount", "variable": "Metric"})
-        st.plotly_chart(fig)
-    elif chart_type == "Histogram":
-        fig = px.histogram(filtered_df, x='TotalPremium',
-                           title="Distribution of Policies by Premium",
-                           color='PolicyType')
-        st.plotly_chart(fig)
-    elif chart_type == "Box Plot":
-        fig = px.box(filtered_df, x='PolicyType', y='TotalPremium',
-                     title="Premium by Line of Business (Box Plot)",
-                     color='PolicyType')
-        st.plotly_chart(fig)
+    render_visualizations(filtered_df)
 else:
     st.warning("Authenticate first to view data and charts.")
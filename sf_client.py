@@ -0,0 +1,22 @@
+import streamlit as st
+from simple_salesforce import Salesforce
+from requests import Session
+from requests.adapters import HTTPAdapter
+import os
+
+
+# Salesforce client shared by every dashboard page, created once per server process
+@st.cache_resource
+def get_sf():
+    """Return a Salesforce client, created once and shared across reruns and pages."""
+    # Retry transient connection errors; the adapter keeps requests' default pool size,
+    # since this one client is shared by every session's script thread
+    session = Session()
+    session.mount("https://", HTTPAdapter(max_retries=3))
+
+    return Salesforce(
+        username=os.getenv("SF_USERNAME_PRO"),
+        password=os.getenv("SF_PASSWORD_PRO"),
+        security_token=os.getenv("SF_SECURITY_TOKEN_PRO"),
+        session=session,
+    )